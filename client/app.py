@@ -1,10 +1,22 @@
+import os
+import sys
 import time
+import random
+import asyncio
+import threading
+from collections import OrderedDict
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, wait
+import aiohttp
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from pathlib import Path
 from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+from watchdog.events import FileSystemEventHandler, FileCreatedEvent, FileClosedEvent, FileMovedEvent, FileDeletedEvent
 import logging
-import hashlib
+import xxhash
+import orjson
 
 # Configure logging
 logging.basicConfig(
@@ -13,85 +25,285 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Files of at least this size are hashed in chunks and streamed from disk
+# instead of being read into memory
+STREAM_THRESHOLD = 16 * 1024 * 1024
+HASH_CHUNK_SIZE = 1 << 20  # read size when hashing large files
+
+# Upload pipeline tuning
+MAX_CONCURRENT_UPLOADS = 8  # files held between reading and upload completion
+UPLOAD_RETRIES = 3
+RETRY_BASE_DELAY = 0.5  # seconds, doubled on every retry
+RETRY_JITTER = 0.5  # seconds of random jitter added to each backoff
+MAX_PROCESSING_WORKERS = 8  # threads reading and hashing new files
+UPLOAD_HEADERS = {'Content-Type': 'application/octet-stream'}
+
+# inotify reports IN_CLOSE_WRITE on Linux, so there is no need to poll
+# for the file size to settle; other platforms fall back to polling
+USE_CLOSE_EVENTS = sys.platform.startswith('linux')
+
+if USE_CLOSE_EVENTS:
+    from watchdog.observers.inotify import InotifyObserver
+
+# Only the events the uploader handles; on Linux this also narrows the
+# inotify mask so per-write IN_MODIFY/IN_OPEN events are never delivered
+WATCHED_EVENTS = [FileCreatedEvent, FileClosedEvent, FileMovedEvent, FileDeletedEvent]
+
+# Temporary and backup file suffixes that are never uploaded
+SKIPPED_SUFFIXES = ('~', '.tmp', '.swp', '.bak')
+
+# Minimum number of seconds between storage status queries to the Master
+STATUS_INTERVAL = 5.0
+
+# Maximum number of entries remembered by each duplicate-detection cache
+MAX_TRACKED_ENTRIES = 100_000
+
+class LRUCache:
+    """Bounded set (or mapping, via get/set) that evicts the least recently used entry"""
+    
+    def __init__(self, maxlen=MAX_TRACKED_ENTRIES):
+        self.maxlen = maxlen
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def __contains__(self, key):
+        with self._lock:
+            if key not in self._items:
+                return False
+            self._items.move_to_end(key)
+            return True
+    
+    def __len__(self):
+        return len(self._items)
+    
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key]
+    
+    def set(self, key, value=None):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            if len(self._items) > self.maxlen:
+                self._items.popitem(last=False)
+    
+    def add(self, key):
+        self.set(key)
+    
+    def discard(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
 class SeaweedFSUploader(FileSystemEventHandler):
     """Uploads new files to SeaweedFS via Filer"""
     
     def __init__(self, filer_url, master_url, watched_dir):
         self.filer_url = filer_url
         self.master_url = master_url
+        self.status_url = f"{master_url}/vol/status"
         self.watched_dir = Path(watched_dir)
-        self.uploaded_files = set()  # Track uploaded files to prevent duplicates
+        self.uploaded_files = LRUCache()  # Track uploaded content to prevent duplicates
         self.processing_files = set()  # Track files currently being processed
-        logger.info(f"Initialized uploader. Filer: {filer_url}, Master: {master_url}, Watching: {watched_dir}")
+        self.dirty_files = set()  # Files that changed while being processed
+        self._stat_cache = LRUCache()  # (size, mtime_ns) of each path when it was last uploaded
+        
+        # Files are read and hashed off the watchdog thread so events
+        # arriving together are processed in parallel
+        self.pool = ThreadPoolExecutor(max_workers=MAX_PROCESSING_WORKERS, thread_name_prefix="file-worker")
+        
+        # Keep-alive session for synchronous calls to the Master
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=64, max_retries=Retry(total=3, backoff_factor=0.2))
+        self.session.mount("http://", adapter)
+        
+        # Uploads run concurrently on a dedicated asyncio loop so the
+        # watchdog thread never blocks on the network
+        self.loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self.loop.run_forever, name="upload-loop", daemon=True)
+        self._loop_thread.start()
+        asyncio.run_coroutine_threadsafe(self._open_session(), self.loop).result()
+        self._uploads = set()  # Futures of uploads submitted to the loop
+        self._lock = threading.Lock()  # Guards _uploads and the check-and-add on the file sets
+        # Caps files held open or in memory until their upload completes
+        self._upload_slots = threading.BoundedSemaphore(MAX_CONCURRENT_UPLOADS)
+        
+        # Storage status is reported from a background thread, at most once
+        # per STATUS_INTERVAL and only after new uploads
+        self._status_pending = threading.Event()
+        self._stopping = threading.Event()
+        self._status_thread = threading.Thread(target=self._status_reporter, name="status-reporter", daemon=True)
+        self._status_thread.start()
+        
+        logger.info("Initialized uploader. Filer: %s, Master: %s, Watching: %s", filer_url, master_url, watched_dir)
     
     def on_created(self, event):
         """Triggered when a new file is created"""
         
+        # On Linux the writer's IN_CLOSE_WRITE drives the upload instead
+        if USE_CLOSE_EVENTS or event.is_directory:
+            return
+        
+        self._submit_file(event.src_path, True)
+    
+    def on_closed(self, event):
+        """Triggered when a file opened for writing is closed (Linux only)"""
+        
         if event.is_directory:
             return
         
-        file_path = Path(event.src_path)
+        self._submit_file(event.src_path, False)
+    
+    def on_moved(self, event):
+        """Triggered when a file is moved or renamed into the watched directory"""
         
-        # Skip temporary and hidden files
-        if self._should_skip_file(file_path):
-            logger.debug(f"Skipping file: {file_path.name}")
+        if event.is_directory:
+            return
+        
+        # The source path no longer holds the uploaded file
+        if event.src_path:
+            self._stat_cache.discard(event.src_path)
+        
+        # A move out of the directory has no destination
+        if not event.dest_path:
+            return
+        
+        # A rename is atomic, so the file is already complete
+        self._submit_file(event.dest_path, False)
+    
+    def on_deleted(self, event):
+        """Triggered when a file is deleted; forgets its last upload"""
+        
+        if event.is_directory:
             return
         
-        # Prevent duplicate processing
-        if file_path in self.processing_files:
-            logger.debug(f"File already being processed: {file_path.name}")
+        self._stat_cache.discard(event.src_path)
+    
+    def _submit_file(self, file_path, wait_for_completion):
+        """Schedules a file for processing on the worker pool"""
+        name = os.path.basename(file_path)
+        
+        # Skip temporary and hidden files
+        if self._should_skip_file(name):
+            logger.debug("Skipping file: %s", name)
             return
         
-        self.processing_files.add(file_path)
+        self.pool.submit(self._handle_new_file, file_path, name, wait_for_completion)
+    
+    def _handle_new_file(self, file_path, name, wait_for_completion):
+        """Hashes a new file and hands it to the upload loop"""
+        
+        # Prevent duplicate processing; a file that changes meanwhile is
+        # processed again once the current pass has finished
+        with self._lock:
+            if file_path in self.processing_files:
+                self.dirty_files.add(file_path)
+                logger.debug("File changed while being processed, will re-check: %s", name)
+                return
+            self.processing_files.add(file_path)
         
-        logger.info(f"New file detected: {file_path.name}")
+        logger.info("New file detected: %s", name)
         
+        data = None
+        holds_slot = False
+        submitted = False
         try:
             # Wait for file to be completely written
-            if not self._wait_for_file_completion(file_path):
-                logger.warning(f"File not stable after timeout: {file_path.name}")
+            if wait_for_completion and not self._wait_for_file_completion(file_path, name):
+                logger.warning("File not stable after timeout: %s", name)
                 return
             
-            # Check if already uploaded
-            file_hash = self._get_file_hash(file_path)
-            if file_hash in self.uploaded_files:
-                logger.info(f"File already uploaded (duplicate): {file_path.name}")
+            # Skip re-reading a file whose size and mtime match its last upload
+            stat = os.stat(file_path)
+            stat_key = (stat.st_size, stat.st_mtime_ns)
+            if self._stat_cache.get(file_path) == stat_key:
+                logger.info("File unchanged since last upload: %s", name)
                 return
             
-            # Upload the file
-            self.upload_file(file_path)
+            # Wait for an upload slot so a burst of files is not all held at once
+            self._upload_slots.acquire()
+            holds_slot = True
             
-            # Mark as uploaded
-            self.uploaded_files.add(file_hash)
+            # Open the file once; the same contents are hashed and uploaded
+            data = self._read_file(file_path)
             
-            # Query and report storage status
-            self.report_storage_status()
+            # Check if already uploaded
+            file_hash = self._get_file_hash(file_path, data)
+            with self._lock:
+                if file_hash in self.uploaded_files:
+                    logger.info("File already uploaded (duplicate): %s", name)
+                    return
+                
+                # Mark as uploaded up front so identical files arriving during
+                # the upload are not sent twice
+                self.uploaded_files.add(file_hash)
+            
+            # Hand off to the upload loop; it releases the file when done
+            future = asyncio.run_coroutine_threadsafe(self._process_upload(file_path, name, data, file_hash, stat_key), self.loop)
+            submitted = True
+            with self._lock:
+                self._uploads.add(future)
+            future.add_done_callback(self._upload_done)
             
         except Exception as e:
-            logger.error(f"Error processing {file_path.name}: {e}")
+            logger.error("Error processing %s: %s", name, e)
+        finally:
+            if not submitted:
+                self._release_file(file_path, data, holds_slot)
+    
+    async def _process_upload(self, file_path, name, data, file_hash, stat_key):
+        """Uploads a file on the upload loop and reports storage status"""
+        try:
+            await self.upload_file(name, data)
+            self._stat_cache.set(file_path, stat_key)
+            
+            # Request a storage status report from the background thread
+            self._status_pending.set()
+            
+        except Exception as e:
+            logger.error("Error processing %s: %s", name, e)
+            # Allow the content to be retried on the next event
+            self.uploaded_files.discard(file_hash)
+        finally:
+            self._release_file(file_path, data)
+    
+    def _upload_done(self, future):
+        """Stops tracking an upload once it has finished"""
+        with self._lock:
+            self._uploads.discard(future)
+    
+    def _release_file(self, file_path, data, holds_slot=True):
+        """Removes the file from the processing set and frees its data and upload slot"""
+        try:
+            with self._lock:
+                self.processing_files.discard(file_path)
+                changed = file_path in self.dirty_files
+                self.dirty_files.discard(file_path)
+            if holds_slot:
+                self._upload_slots.release()
+            if changed:
+                self._requeue_file(file_path)
         finally:
-            # Remove from processing set
-            self.processing_files.discard(file_path)
+            if hasattr(data, 'close'):
+                data.close()
+    
+    def _requeue_file(self, file_path):
+        """Processes a file again after it changed while being processed"""
+        name = os.path.basename(file_path)
+        logger.info("File changed during upload, re-checking: %s", name)
+        try:
+            self.pool.submit(self._handle_new_file, file_path, name, not USE_CLOSE_EVENTS)
+        except RuntimeError:
+            logger.warning("Shutting down, not re-uploading: %s", name)
     
-    def _should_skip_file(self, file_path):
+    def _should_skip_file(self, name):
         """Check if file should be skipped"""
-        name = file_path.name
-        
-        # Skip hidden files (starting with .)
-        if name.startswith('.'):
-            return True
-        
-        # Skip temporary files
-        if name.endswith('~') or name.endswith('.tmp') or name.endswith('.swp'):
-            return True
-        
-        # Skip backup files
-        if name.endswith('.bak'):
-            return True
-        
-        return False
+        # Skip hidden files (starting with .) and temporary/backup files
+        return name.startswith('.') or name.endswith(SKIPPED_SUFFIXES)
     
-    def _wait_for_file_completion(self, file_path, timeout=10):
+    def _wait_for_file_completion(self, file_path, name, timeout=10):
         """Wait until file size stabilizes (file finished writing)"""
         last_size = -1
         stable_count = 0
@@ -100,111 +312,174 @@ class SeaweedFSUploader(FileSystemEventHandler):
         
         while time.time() - start_time < timeout:
             try:
-                current_size = file_path.stat().st_size
+                current_size = os.stat(file_path).st_size
                 
                 if current_size == last_size:
                     stable_count += 1
                     if stable_count >= required_stable_checks:
-                        logger.debug(f"File stable: {file_path.name} ({current_size} bytes)")
+                        logger.debug("File stable: %s (%s bytes)", name, current_size)
                         return True
                 else:
                     stable_count = 0
-                    logger.debug(f"File still growing: {file_path.name} ({current_size} bytes)")
+                    logger.debug("File still growing: %s (%s bytes)", name, current_size)
                 
                 last_size = current_size
                 time.sleep(0.5)
                 
             except OSError as e:
-                logger.debug(f"Waiting for file access: {file_path.name} - {e}")
+                logger.debug("Waiting for file access: %s - %s", name, e)
                 time.sleep(0.5)
         
         return False
     
-    def _get_file_hash(self, file_path):
+    def _read_file(self, file_path):
+        """Opens a file for hashing and upload, reading small files into memory"""
+        f = open(file_path, 'rb')
+        if os.fstat(f.fileno()).st_size >= STREAM_THRESHOLD:
+            # Large files stay open: hashed in chunks, then rewound and uploaded
+            return f
+        with f:
+            return f.read()
+    
+    def _get_file_hash(self, file_path, data):
         """Calculate file hash for duplicate detection"""
         try:
-            hash_md5 = hashlib.md5()
-            with open(file_path, "rb") as f:
-                for chunk in iter(lambda: f.read(4096), b""):
-                    hash_md5.update(chunk)
-            return hash_md5.hexdigest()
+            # Non-cryptographic XXH3-128 is sufficient for identity checks
+            hasher = xxhash.xxh3_128()
+            if isinstance(data, bytes):
+                hasher.update(data)
+            else:
+                for chunk in iter(lambda: data.read(HASH_CHUNK_SIZE), b""):
+                    hasher.update(chunk)
+            return hasher.digest()
         except Exception as e:
-            logger.error(f"Error calculating hash for {file_path.name}: {e}")
+            logger.error("Error calculating hash for %s: %s", os.path.basename(file_path), e)
             # Return path as fallback
-            return str(file_path)
+            return file_path
+    
+    async def _open_session(self):
+        """Creates the shared HTTP session on the upload loop"""
+        connector = aiohttp.TCPConnector(limit=32, keepalive_timeout=60)
+        # Per-operation timeouts like requests' timeout; a total cap would
+        # fail any upload that takes longer than that to send
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=30)
+        self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
     
-    def upload_file(self, file_path):
-        """Uploads a file to SeaweedFS via Filer to root directory"""
+    def close(self):
+        """Drains the workers and submitted uploads, then closes the HTTP sessions and stops the loop and status reporter"""
+        self.pool.shutdown(wait=True)
+        
+        with self._lock:
+            pending = list(self._uploads)
+        if pending:
+            logger.info("Waiting for %d upload(s) to finish...", len(pending))
+            wait(pending)
+        
+        asyncio.run_coroutine_threadsafe(self._session.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._loop_thread.join()
+        self.loop.close()
+        
+        self._stopping.set()
+        self._status_pending.set()
+        self._status_thread.join()
+        self.session.close()
+    
+    def _open_body(self, data):
+        """Returns a context manager yielding the upload body for one attempt"""
+        if isinstance(data, bytes):
+            return nullcontext(data)
+        
+        # Rewind the handle that was hashed and give aiohttp its own
+        # descriptor for it, which it is free to close
+        data.seek(0)
+        return os.fdopen(os.dup(data.fileno()), 'rb')
+    
+    async def upload_file(self, name, data):
+        """Uploads file contents to SeaweedFS via Filer to root directory"""
         
         # Upload directly to Filer with file name preserved
         # Filer will handle the assignment and storage automatically
-        upload_url = f"{self.filer_url}/{file_path.name}"
+        upload_url = f"{self.filer_url}/{name}"
         
-        try:
-            with open(file_path, 'rb') as f:
-                files = {'file': (file_path.name, f)}
-                response = requests.post(upload_url, files=files, timeout=30)
-                response.raise_for_status()
+        for attempt in range(UPLOAD_RETRIES):
+            try:
+                # PUT the contents as a raw body, the Filer's non-multipart
+                # write path; large files are streamed from disk
+                with self._open_body(data) as body:
+                    async with self._session.put(upload_url, data=body, headers=UPLOAD_HEADERS) as response:
+                        response.raise_for_status()
+                        
+                        # Parse response to get file details
+                        result = await response.json(content_type=None)
                 
-                # Parse response to get file details
-                result = response.json()
                 fid = result.get('fid', 'N/A')
                 size = result.get('size', 0)
                 
-                logger.info(f"✓ Successfully uploaded: {file_path.name} (fid: {fid}, size: {size} bytes)")
+                logger.info("✓ Successfully uploaded: %s (fid: %s, size: %s bytes)", name, fid, size)
+                return
                 
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Failed to upload file to Filer: {e}")
-            raise
-        except IOError as e:
-            logger.error(f"Failed to read file {file_path}: {e}")
-            raise
-        except Exception as e:
-            logger.error(f"Unexpected error during upload: {e}")
-            raise
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                # 4xx responses will not succeed on retry; only connection
+                # errors, timeouts and 5xx responses are retried
+                rejected = isinstance(e, aiohttp.ClientResponseError) and e.status < 500
+                if rejected or attempt == UPLOAD_RETRIES - 1:
+                    logger.error("Failed to upload file to Filer: %s", e)
+                    raise
+                
+                # Exponential backoff with jitter
+                delay = RETRY_BASE_DELAY * 2 ** attempt + random.random() * RETRY_JITTER
+                logger.warning("Upload of %s failed (%s), retrying in %.1fs", name, e, delay)
+                await asyncio.sleep(delay)
+    
+    def _status_reporter(self):
+        """Reports storage status after uploads, rate-limited to STATUS_INTERVAL"""
+        while True:
+            self._status_pending.wait()
+            if self._stopping.is_set():
+                return
+            self._status_pending.clear()
+            self.report_storage_status()
+            self._stopping.wait(STATUS_INTERVAL)
     
     def report_storage_status(self):
         """Queries and prints storage status from Master"""
         
         # Get volume statistics from Master server
         # Master has the authoritative view of all volumes in the cluster
-        volumes_url = f"{self.master_url}/vol/status"
-        
         try:
-            vol_response = requests.get(volumes_url, timeout=10)
+            vol_response = self.session.get(self.status_url, timeout=10)
             vol_response.raise_for_status()
-            vol_data = vol_response.json()
+            vol_data = orjson.loads(vol_response.content)
             
-            total_size = 0
-            total_files = 0
-            volume_count = 0
-            
-            # Navigate through the nested structure:
+            # Flatten the nested structure:
             # Volumes -> DataCenters -> {dc_name} -> {rack_name} -> {node_url} -> [volume_list]
             volumes_data = vol_data.get('Volumes', {})
             data_centers = volumes_data.get('DataCenters', {})
             
-            for dc_name, dc_data in data_centers.items():
-                for rack_name, rack_data in dc_data.items():
-                    for node_url, volume_list in rack_data.items():
-                        if isinstance(volume_list, list):
-                            for volume in volume_list:
-                                if isinstance(volume, dict):
-                                    size = volume.get('Size', 0)
-                                    files = volume.get('FileCount', 0)
-                                    total_size += size
-                                    total_files += files
-                                    volume_count += 1
+            volumes = [
+                volume
+                for dc_data in data_centers.values()
+                for rack_data in dc_data.values()
+                for volume_list in rack_data.values()
+                if isinstance(volume_list, list)
+                for volume in volume_list
+                if isinstance(volume, dict)
+            ]
+            
+            total_size = sum(volume.get('Size', 0) for volume in volumes)
+            total_files = sum(volume.get('FileCount', 0) for volume in volumes)
+            volume_count = len(volumes)
             
             # Convert to MB for readability
             total_mb = total_size / (1024 * 1024)
             
-            logger.info(f"📊 Storage Status: {total_size:,} bytes ({total_mb:.2f} MB) | Files: {total_files} | Volumes: {volume_count}")
+            logger.info("📊 Storage Status: %s bytes (%.2f MB) | Files: %s | Volumes: %s", format(total_size, ","), total_mb, total_files, volume_count)
             
         except requests.exceptions.RequestException as e:
-            logger.error(f"Failed to get storage status from Master: {e}")
+            logger.error("Failed to get storage status from Master: %s", e)
         except Exception as e:
-            logger.error(f"Error parsing storage status: {e}")
+            logger.error("Error parsing storage status: %s", e)
 
 def main():
     """Service entry point"""
@@ -234,10 +509,10 @@ def main():
                 logger.info("✓ SeaweedFS Filer is ready!")
                 break
         except requests.exceptions.RequestException as e:
-            logger.debug(f"Retry {i+1}/{max_retries}: {e}")
+            logger.debug("Retry %d/%d: %s", i + 1, max_retries, e)
         
         if i == max_retries - 1:
-            logger.error(f"Failed to connect to SeaweedFS Filer after {max_retries} attempts")
+            logger.error("Failed to connect to SeaweedFS Filer after %s attempts", max_retries)
             return
         
         time.sleep(retry_delay)
@@ -251,15 +526,21 @@ def main():
         else:
             logger.warning("Master server responded but may not be fully ready")
     except requests.exceptions.RequestException as e:
-        logger.warning(f"Could not verify Master server: {e}")
+        logger.warning("Could not verify Master server: %s", e)
     
     # Start monitoring
     event_handler = SeaweedFSUploader(FILER_URL, MASTER_URL, WATCHED_DIR)
-    observer = Observer()
-    observer.schedule(event_handler, WATCHED_DIR, recursive=False)
+    if USE_CLOSE_EVENTS:
+        # on_closed relies on inotify; full events report files moved in
+        # from outside as moves instead of creations, so on_created can
+        # leave newly created files to on_closed
+        observer = InotifyObserver(generate_full_events=True)
+    else:
+        observer = Observer()
+    observer.schedule(event_handler, WATCHED_DIR, recursive=False, event_filter=WATCHED_EVENTS)
     observer.start()
     
-    logger.info(f"👁 Monitoring directory: {WATCHED_DIR}")
+    logger.info("👁 Monitoring directory: %s", WATCHED_DIR)
     logger.info("Press Ctrl+C to stop")
     logger.info("=" * 60)
     
@@ -271,6 +552,7 @@ def main():
         observer.stop()
     
     observer.join()
+    event_handler.close()
     logger.info("Service stopped")
 
 if __name__ == "__main__":
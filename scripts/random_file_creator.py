@@ -41,7 +41,7 @@ logger = logging.getLogger("RandomFileGenerator")
 def random_text(length=100):
     """Generate random alphanumeric string."""
     chars = string.ascii_letters + string.digits + " "
-    return ''.join(random.choice(chars) for _ in range(length))
+    return ''.join(random.choices(chars, k=length))
 
 def create_random_file(target_dir: Path):
     """Create a random text file in the specified directory."""